@@ -6,4 +6,5 @@ Created on Tue Mar 12 23:05:12 EDT 2013
 @author: winman@mit.edu
 """
 
-__all__ = ["makehex", "utils", "makeuser"]
+__all__ = ["makehex", "utils", "makeuser", "crc", "bench", "cache", "service",
+        "mergehex"]
@@ -0,0 +1,37 @@
+#!/bin/sh
+# thin client for service.py that does not start python, see service.py
+# $ sh avr32hex.sh makehex|makeuser [options]
+# the job goes to the service with socat, without socat or a service
+# listening the python client is run instead (which does the job itself)
+
+sock=${AVR32HEX_SOCK:-${TMPDIR:-/tmp}/avr32hex.sock}
+here=$(dirname "$0")
+
+quote() {
+    printf '"%s"' "$(printf '%s' "$1" | sed 's/\\/\\\\/g; s/"/\\"/g')"
+}
+
+if [ $# -lt 1 ] || [ ! -S "$sock" ] || ! command -v socat >/dev/null; then
+    exec python "$here/service.py" "$@"
+fi
+
+tool=$1
+shift
+args=""
+for arg in "$@"; do
+    args="$args${args:+, }$(quote "$arg")"
+done
+
+reply=$(mktemp) || exit 1
+trap 'rm -f "$reply"' EXIT
+printf '{"tool": %s, "args": [%s], "cwd": %s, "raw": true}\n' \
+    "$(quote "$tool")" "$args" "$(quote "$PWD")" |
+    socat - "UNIX-CONNECT:$sock" > "$reply"
+status=$(head -n 1 "$reply")
+case $status in
+    ''|*[!0-9]*)
+        rm -f "$reply"
+        exec python "$here/service.py" "$tool" "$@" ;;
+esac
+tail -n +2 "$reply"
+exit "$status"
@@ -0,0 +1,266 @@
+""""
+timing for the hex encoder, crc and user page paths
+
+$ python bench.py [-q] [-s] [-b {baseline file}]
+    -q : quick, leave out the large images
+    -s : save the results as the new baseline
+    -b {filename} : baseline file, default bench_baseline.json
+
+every case runs in its own process on synthetic data, the memory reported
+is how far the peak RSS of that process grew over the timed runs (what the
+setup already used is not counted), results are compared with the baseline
+and anything more than 20% slower is flagged, a case that fails is reported
+and the rest still run
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future_builtins import (ascii, filter, hex, map, oct, zip)
+
+import logging as log
+import sys
+import os
+import json
+import random
+import resource
+import shutil
+import tempfile
+import time
+import traceback
+import multiprocessing
+import Queue
+from avr32.makehex import makehex, bin2hex, _ihex_makeline
+from avr32.crc import getCRC8, getCRC8s
+from avr32.makeuser import makeuser, makeusers
+from avr32.mergehex import mergeunits
+
+SIZES = (512, 4096, 0x10000, 512 * 1024, 8 * 1024 * 1024)
+COLS = (16, 32, 64, 128, 255)
+BASELINE = "bench_baseline.json"
+
+
+def colsbench(size=512 * 1024, colslist=(16, 32, 64, 128, 255), repeat=3):
+    """
+    encode a random binary of size bytes with each record length in colslist
+    prints and returns a list of (cols, records, hex bytes, seconds)
+    the time is the best of repeat runs
+    """
+    data = bytearray(os.urandom(size))
+    results = []
+    print("cols   records   hex bytes   seconds    MB/s")
+    for cols in colslist:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            text = bin2hex(data, 0x80000000, cols)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        records = text.count("\n")
+        results.append((cols, records, len(text), best))
+        print("{0:>4} {1:>9} {2:>11} {3:>9.3f} {4:>7.2f}".format(cols,
+            records, len(text), best, size / best / 1e6))
+    return results
+
+def cases(quick=False):
+    """
+    return a list of (name, setup) where setup(workdir) makes the synthetic
+    input and returns (run, nbytes), run being the timed part
+    """
+    sizes = [s for s in SIZES if not quick or s <= 0x10000]
+    found = []
+    for size in sizes:
+        for cols in COLS:
+            found.append(("makehex {0}B cols {1}".format(size, cols),
+                _makehexcase(size, cols, False)))
+        found.append(("makehex {0}B stream".format(size),
+            _makehexcase(size, 16, True)))
+        if size >= 0x80000:
+            found.append(("makehex {0}B parallel".format(size),
+                _makehexcase(size, 16, False, None)))
+    found.append(("_ihex_makeline x10000", _makelinecase))
+    found.append(("getCRC8 x100000", _crccase))
+    found.append(("getCRC8s x100000", _crcbulkcase))
+    found.append(("makeuser single x20", _makeusercase))
+    found.append(("makeusers bulk x1000", _makeuserscase))
+    found.append(("mergeunits 512KB x100", _mergeunitscase))
+    return found
+
+def _makehexcase(size, cols, stream, processes=1):
+    def setup(workdir):
+        binfile = os.path.join(workdir, "bench.bin")
+        hexfile = os.path.join(workdir, "bench.hex")
+        _writerandom(binfile, size)
+        return (lambda: makehex(binfile, hexfile, 0x80000000, cols,
+            stream=stream, processes=processes)), size
+    return setup
+
+def _makelinecase(workdir):
+    rnd = random.Random(0)
+    records = [[rnd.randrange(256) for _ in range(19)] for _ in range(10000)]
+    def run():
+        for values in records:
+            _ihex_makeline(list(values))
+    return run, 16 * len(records)
+
+def _crccase(workdir):
+    words = _randomwords(100000)
+    def run():
+        for w in words:
+            getCRC8(w)
+    return run, 3 * len(words)
+
+def _crcbulkcase(workdir):
+    words = _randomwords(100000)
+    return (lambda: getCRC8s(words)), 3 * len(words)
+
+def _makeusercase(workdir):
+    def run():
+        for k in range(20):
+            makeuser("1010-0000-5115-{0:0>4}".format(k),
+                    filename=os.path.join(workdir, "unit{0}".format(k)))
+    return run, 20 * 512
+
+def _makeuserscase(workdir):
+    serialnums = ["1010-0000-5115-{0:0>4}".format(k) for k in range(1000)]
+    return (lambda: makeusers(serialnums, directory=workdir)), 1000 * 512
+
+def _mergeunitscase(workdir):
+    binfile = os.path.join(workdir, "base.bin")
+    _writerandom(binfile, 512 * 1024)
+    makehex(binfile)
+    units = os.path.join(workdir, "units")
+    merged = os.path.join(workdir, "merged")
+    os.makedirs(units)
+    os.makedirs(merged)
+    overlays = makeusers(["1010-0000-5115-{0:0>4}".format(k)
+        for k in range(100)], directory=units, processes=1)
+    return (lambda: mergeunits(os.path.join(workdir, "base.hex"), overlays,
+        merged)), 100 * 512
+
+def _writerandom(filename, size, block=0x10000):
+    """ write size random bytes a block at a time, so they are not all held """
+    with open(filename, 'wb') as fh:
+        for k in range(0, size, block):
+            fh.write(os.urandom(min(block, size - k)))
+
+def _randomwords(n):
+    rnd = random.Random(n)
+    return [rnd.getrandbits(24) for _ in range(n)]
+
+def measure(setup, repeat=3):
+    """
+    run a case in a child process
+    returns (best seconds, nbytes, growth of the peak RSS in KB)
+    raises a RuntimeError if the case fails or the child dies
+    """
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_child, args=(setup, repeat, queue))
+    child.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1.0)
+        except Queue.Empty:
+            if not child.is_alive():
+                child.join()
+                raise RuntimeError("case died with exit code {0}".format(
+                    child.exitcode))
+    child.join()
+    if result[0] == "error":
+        raise RuntimeError(result[1])
+    return result[1:]
+
+def _child(setup, repeat, queue):
+    workdir = tempfile.mkdtemp()
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        run, nbytes = setup(workdir)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        queue.put(("ok", best, nbytes, growth))
+    except Exception:
+        queue.put(("error", traceback.format_exc()))
+    finally:
+        shutil.rmtree(workdir)
+
+def runbench(quick=False, save=False, baseline=BASELINE, repeat=3):
+    """
+    run every case, print the results next to the baseline and return them
+    as a dict of name: {seconds, MBps, rss_kb}, failed cases are left out
+    if save is set the results become the new baseline
+    """
+    previous = {}
+    if os.path.exists(baseline):
+        with open(baseline, 'r') as fh:
+            previous = json.load(fh)
+
+    results = {}
+    print("{0:<32} {1:>9} {2:>9} {3:>10} {4:>9}".format("case", "seconds",
+        "MB/s", "RSS+ KB", "baseline"))
+    for name, setup in cases(quick):
+        try:
+            seconds, nbytes, growth = measure(setup, repeat)
+        except RuntimeError as e:
+            print("{0:<32} FAILED".format(name))
+            log.error("{0}: {1}".format(name, e))
+            continue
+        results[name] = {"seconds": seconds, "MBps": nbytes / seconds / 1e6,
+                "rss_kb": growth}
+        note = ""
+        if name in previous:
+            ratio = seconds / previous[name]["seconds"]
+            note = "{0:.2f}x".format(ratio)
+            if ratio > 1.2:
+                note += " SLOWER"
+        print("{0:<32} {1:>9.4f} {2:>9.2f} {3:>10} {4:>9}".format(name,
+            seconds, nbytes / seconds / 1e6, growth, note))
+
+    if save:
+        previous.update(results)
+        with open(baseline, 'w') as fh:
+            json.dump(previous, fh, indent=1, sort_keys=True)
+    return results
+
+def parseargs(args):
+    """
+    parse argument options -q, -s, -b
+    """
+    quick = False
+    save = False
+    baseline = BASELINE
+    while (len(args)):
+        if args[0] == '-q':
+            quick = True
+            args = args[1:]
+        elif args[0] == '-s':
+            save = True
+            args = args[1:]
+        elif args[0] == '-b' and len(args) > 1:
+            baseline = args[1]
+            args = args[2:]
+        else:
+            return (False, 0, 0, 0)
+    return (True, quick, save, baseline)
+
+def printcommands():
+    print("bench [-q] [-s] [-b {baseline file}]")
+    print("\t-q : quick, leave out the large images")
+    print("\t-s : save the results as the new baseline")
+    print("\t-b {filename} : baseline file, default bench_baseline.json")
+
+
+if __name__=="__main__":
+    log.basicConfig(level=log.DEBUG)
+    success, quick, save, baseline = parseargs(sys.argv[1:])
+    if success:
+        runbench(quick, save, baseline)
+    else:
+        printcommands()
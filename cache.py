@@ -0,0 +1,208 @@
+""""
+an on disk cache for generated hex files
+
+the key is the sha1 of the input bytes and every encoding parameter, so a
+conversion that was already done is read back instead of made again
+the cache is kept under maxbytes by removing the least recently used files
+
+makehex.py, makeuser.py and service.py serve use it with -C {directory}
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future_builtins import (ascii, filter, hex, map, oct, zip)
+
+import logging as log
+import os
+import hashlib
+import shutil
+import tempfile
+from avr32 import makehex as _makehex
+from avr32.makehex import bin2hex
+from avr32.makeuser import makepage
+
+# change this when the encoder output changes so old entries are not used
+CACHE_VERSION = 1
+
+
+class HexCache(object):
+    """
+    cache of hex text in directory, at most maxbytes of it
+    hits and misses count the lookups made through this object
+    """
+
+    def __init__(self, directory="~/.cache/avr32hex", maxbytes=256 * 2**20):
+        self.directory = os.path.expanduser(directory)
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, data, *params):
+        """
+        key for data (bytes-like) encoded with params
+        """
+        sha = self._params(params)
+        sha.update(data)
+        return sha.hexdigest()
+
+    def keyfile(self, filename, *params, **kwargs):
+        """
+        key for the contents of filename encoded with params, the file is
+        read blocksize bytes at a time
+        """
+        blocksize = kwargs.get("blocksize", 2**20)
+        sha = self._params(params)
+        with open(filename, 'rb') as fh:
+            for block in iter(lambda: fh.read(blocksize), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        return the cached text for key, or None
+        """
+        path = self._hit(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'r') as fh:
+                return fh.read()
+        except IOError:
+            # evicted by another process since
+            return None
+
+    def put(self, key, text):
+        """
+        store text under key, then trim the cache to maxbytes
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(text)
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def putfile(self, key, filename):
+        """
+        store a copy of the file filename under key, then trim the cache
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(filename, tmp)
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        remove the least recently used entries until at most maxbytes remain
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".hex"):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            log.debug("evicted {0} from hex cache".format(name))
+
+    def bin2hex(self, data, offset=0x80000000, cols=16, prepend_size=False,
+            skipblank=False):
+        """
+        makehex.bin2hex through the cache
+        """
+        key = self.bin2hexkey(data, offset, cols, prepend_size, skipblank)
+        text = self.get(key)
+        if text is None:
+            text = bin2hex(data, offset, cols, prepend_size, skipblank)
+            self.put(key, text)
+        return text
+
+    def bin2hexkey(self, data, offset=0x80000000, cols=16, prepend_size=False,
+            skipblank=False):
+        """
+        the key bin2hex keeps its result for these arguments under
+        """
+        return self.key(data, "bin2hex", int(offset), cols, bool(prepend_size),
+                bool(skipblank))
+
+    def makehex(self, binfile="program.bin", hexfile=None, offset=0x80000000,
+            cols=16, prepend_size=False, stream=False, skipblank=False,
+            window=None, processes=1):
+        """
+        makehex.makehex through the cache, with the same arguments
+        the binary is hashed a block at a time and a hit is copied file to
+        file, so neither is held in memory
+        """
+        if hexfile is None:
+            hexfile = '.'.join([os.path.splitext(binfile)[0], "hex"])
+        key = self.keyfile(binfile, "makehex", int(offset), cols,
+                bool(prepend_size), bool(skipblank), window)
+        path = self._hit(key)
+        if path is not None:
+            try:
+                shutil.copyfile(path, hexfile)
+                return
+            except IOError:
+                pass
+        _makehex.makehex(binfile, hexfile, offset, cols, prepend_size,
+                stream, skipblank, window, processes)
+        self.putfile(key, hexfile)
+
+    def makeuserhex(self, serialnum="", pin=5, pinhigh=False):
+        """
+        makeuser.makeuserhex through the cache
+        """
+        key = self.key(b"", "makeuserhex", serialnum, pin, bool(pinhigh))
+        text = self.get(key)
+        if text is None:
+            text = bin2hex(makepage(serialnum, pin, pinhigh), 0x80800000)
+            self.put(key, text)
+        return text
+
+    def stats(self):
+        """
+        return (hits, misses, entries, bytes on disk)
+        """
+        sizes = [os.path.getsize(os.path.join(self.directory, name))
+                for name in os.listdir(self.directory) if name.endswith(".hex")]
+        return (self.hits, self.misses, len(sizes), sum(sizes))
+
+    def _hit(self, key):
+        """
+        the path of the entry for key (marked as just used), or None
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def _params(self, params):
+        """
+        a sha1 started with the version and params, each turned into text
+        so ie 'AB' and u'AB' or 1 and 1L give the same key
+        """
+        text = "\0".join("{0}".format(p) for p in (CACHE_VERSION,) + params)
+        return hashlib.sha1(text.encode('utf-8'))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".hex")
@@ -0,0 +1,85 @@
+""""
+table driven CRC8 used for the isp configuration word in the user page
+
+C(x) = x^8 + x^2 + x^1 + x^0 == 1 0 0 0 0 0 1 1 1
+
+the configuration word for every pin and pin condition is worked out once
+when the module is loaded, so making a word is a dictionary lookup
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future_builtins import (ascii, filter, hex, map, oct, zip)
+
+POLYNOMIAL = 0x107
+MAGIC = 0x494F
+
+
+def _maketable():
+    """
+    crc of every single byte, msb first with the crc starting at 0
+    """
+    table = []
+    for v in range(256):
+        for _ in range(8):
+            v = (v << 1) ^ POLYNOMIAL if v & 0x80 else v << 1
+        table.append(v)
+    return table
+
+CRC8_TABLE = _maketable()
+
+
+def crc8(data, crc=0):
+    """
+    return the crc of data, any sequence of byte values (bytearray, list)
+    crc is the value to start from so a long message can be done in pieces
+    """
+    table = CRC8_TABLE
+    for v in bytearray(data):
+        crc = table[crc ^ v]
+    return crc
+
+def getCRC8(word3):
+    """
+    calculate one byte cyclic redundancy check of the 3 byte word3
+
+    matches the bit serial LFSR from:
+    http://ghsi.de/CRC/index.php?Polynom=100000111&Message=929E05
+    """
+    table = CRC8_TABLE
+    return table[table[table[0xFF & (word3 >> 16)] ^ (0xFF & (word3 >> 8))]
+            ^ (0xFF & word3)]
+
+def getCRC8s(words3):
+    """
+    getCRC8 for each value in words3, returned as a list
+    """
+    table = CRC8_TABLE
+    return [table[table[table[0xFF & (w >> 16)] ^ (0xFF & (w >> 8))]
+            ^ (0xFF & w)] for w in words3]
+
+def _cfgword(pin, pinhigh):
+    """
+    work out the 4 byte cfg word for pin as a tuple of byte values
+    """
+    pval = 1 if pinhigh else 0
+    word3 = ((MAGIC<<17) + (pval<<16) + (pin<<8))>>8
+    word = (word3<<8) + getCRC8(word3)
+    return tuple(0xFF & (word >> s) for s in (24, 16, 8, 0))
+
+CFG_WORDS = dict(((pin, pinhigh), _cfgword(pin, pinhigh))
+        for pin in range(256) for pinhigh in (False, True))
+
+
+def cfgword(pin=5, pinhigh=False):
+    """
+    return the isp cfg word for pin and pin condition as a list with 4 byte
+    values, the first 3 bytes are the magic, pin condition and pin number
+    and the last is their crc
+    """
+    key = (pin, bool(pinhigh))
+    if key in CFG_WORDS:
+        return list(CFG_WORDS[key])
+    return list(_cfgword(pin, pinhigh))
@@ -11,68 +11,346 @@ from future_builtins import (ascii, filter, hex, map, oct, zip)
 import logging as log
 import sys
 import os
+import binascii
+import mmap
+import struct
+import multiprocessing
+
+ELFMAG = b"\x7fELF"
+PT_LOAD = 1
 
 
 def makehex(binfile="program.bin", hexfile=None, offset=0x80000000, cols=16,
-        prepend_size = False):
+        prepend_size = False, stream=False, skipblank=False, window=None,
+        processes=1):
     """
     make an intel hex file from a binary
     see wikipedia page for translation
     start is the starting address in memory
-    cols is either 16 or 32, if hexfile is not provided same file name is used
+    cols is the number of data bytes per record, 1 to 255 (16 or 32 are the
+    usual), if hexfile is not provided same file name is used
     with .hex extension instead of binary
+    if stream is set the records are written as they are made, so memory use
+    stays flat no matter how large the binary is
+    if skipblank is set records that are all 0xFF are left out, which is
+    only right when the flash is erased before it is programmed
+    window is an optional (start, length) to convert only length bytes from
+    start in the binary (length None for the rest of it), they keep their
+    place so the first is at offset + start
+    binfile can also be an ELF file, then each loadable segment is placed at
+    its physical address and offset, prepend_size and window are not used
+    the binary is memory mapped, only the records being made are read in
+    processes other than 1 encodes the 64K regions in a pool of that many
+    processes (None for one per cpu), each reading its own region from
+    binfile, the output is the same as with one
     """
     if hexfile is None:
         hexfile = '.'.join([os.path.splitext(binfile)[0], "hex"])
     with open(binfile, 'rb') as fh:
-        page = fh.read()
+        size = os.fstat(fh.fileno()).st_size
+        mm = None
+        if size:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm is not None and mm[:4] == ELFMAG:
+                if prepend_size or window is not None:
+                    raise ValueError("prepend_size and window are not used "
+                            "with an ELF file")
+                if processes == 1:
+                    lines = itersegments(elfsegments(mm), cols, skipblank)
+                else:
+                    jobs = []
+                    for address, position, length in sorted(_elfloads(mm),
+                            key=lambda s: s[0]):
+                        jobs.extend(_regionjobs(binfile, position, length,
+                            address, cols, skipblank))
+                    lines = _iterjobs(jobs, skipblank, processes)
+            else:
+                start, length = window if window is not None else (0, None)
+                if length is None:
+                    length = size - start
+                if start < 0 or length < 0 or start + length > size:
+                    raise ValueError("window is outside of {0}".format(
+                        binfile))
+                if processes == 1:
+                    source = buffer(mm, start, length) if length else b""
+                    lines = iterhex(source, length, int(offset) + start, cols,
+                            prepend_size, skipblank=skipblank)
+                else:
+                    header = _sizeheader(length) if prepend_size else b""
+                    lines = _iterjobs(_regionjobs(binfile, start, length,
+                        int(offset) + start, cols, skipblank, header),
+                        skipblank, processes)
+            if stream:
+                with open(hexfile, 'w') as hfh:
+                    _writelines(hfh, lines)
+            else:
+                text = "\n".join(lines)
+                with open(hexfile, 'w') as hfh:
+                    hfh.write(text)
+        finally:
+            if mm is not None:
+                mm.close()
 
-    offset = int(offset)
+def bin2hex(data, offset=0x80000000, cols=16, prepend_size=False,
+        skipblank=False):
+    """
+    return the text of an intel hex file for data, which can be any
+    bytes-like object (str, bytearray, memoryview, mmap)
+    this is makehex without the files
+    """
+    return "\n".join(iterhex(data, None, offset, cols, prepend_size,
+        skipblank=skipblank))
 
-    if offset % 0x10000:
-        remainder = offset % 0x10000
-        offsetaddress = offset - remainder
-        values = [(0xFF & ((remainder) >> 8)),
-                    (0xFF & (remainder)), 0]
+def segments2hex(segments, cols=16, skipblank=False):
+    """
+    return the text of an intel hex file holding each (address, data) in
+    segments, see itersegments
+    """
+    return "\n".join(itersegments(segments, cols, skipblank))
+
+def itersegments(segments, cols=16, skipblank=False):
+    """
+    generator giving the lines of an intel hex file holding each
+    (address, data) in segments, in address order, data being any bytes-like
+    object
+    a type 04 record is only written when the 64K region changes
+    """
+    region = None
+    for address, data in sorted(segments, key=lambda s: s[0]):
+        if not len(data):
+            continue
+        for line in iterhex(data, None, address, cols, skipblank=skipblank):
+            rtype = line[7:9]
+            if rtype == "01":
+                continue
+            if rtype == "04":
+                if line == region:
+                    continue
+                region = line
+            yield line
+    yield ":00000001FF\n"
+
+def elfsegments(image):
+    """
+    return the loadable segments of an ELF file as a list of
+    (physical address, data) with data a buffer into image, which is the
+    whole file as any bytes-like object (ie an mmap)
+    only the bytes stored in the file are given, not the zeroed .bss part
+    """
+    return [(address, buffer(image, position, length))
+            for address, position, length in _elfloads(image)]
+
+def _elfloads(image):
+    """
+    the loadable segments of an ELF file, as a list of
+    (physical address, position in the file, length)
+    """
+    ident = bytearray(image[:16])
+    if bytes(ident[:4]) != ELFMAG:
+        raise ValueError("not an ELF file")
+    if ident[4] != 1:
+        raise ValueError("only 32 bit ELF files are supported")
+    endian = ">" if ident[5] == 2 else "<"
+    phoff, = struct.unpack(endian + "I", image[28:32])
+    phentsize, phnum = struct.unpack(endian + "HH", image[42:46])
+
+    segments = []
+    for k in range(phnum):
+        start = phoff + k * phentsize
+        (ptype, poffset, vaddr, paddr, filesz, memsz, flags,
+                align) = struct.unpack(endian + "8I", image[start:start + 32])
+        if ptype != PT_LOAD or not filesz:
+            continue
+        if poffset + filesz > len(image):
+            raise ValueError("ELF segment {0} is past the end of the "
+                    "file".format(k))
+        segments.append((paddr, poffset, filesz))
+    return segments
+
+def iterhex(source, size=None, offset=0x80000000, cols=16,
+        prepend_size=False, chunksize=0x10000, skipblank=False):
+    """
+    generator giving the lines of an intel hex file
+    source is either an open binary file, of which size bytes are read, or a
+    bytes-like buffer, of which the first size bytes (default all) are used
+    at most chunksize bytes are taken at a time (rounded down to a multiple
+    of cols so records are cut the same way)
+    the last line is the end of file record
+    records never cross a 64K boundary, the count of cols restarts at each
+    type 04 record
+    with skipblank records that are all 0xFF are left out, as is the type 04
+    record of a 64K region with nothing else in it
+    """
+    if not 0 < cols <= 0xFF:
+        raise ValueError("cols must be between 1 and 255")
+    if hasattr(source, '__getitem__'):
+        chunk = lambda pos, n: source[pos:pos + n]
+        if size is None:
+            size = len(source)
     else:
-        offsetaddress = offset
-        values = [0, 0, 0]
-    lines = [_ihex_make04offset(int(offsetaddress))]
+        chunk = lambda pos, n: source.read(n)
+        if size is None:
+            size = os.fstat(source.fileno()).st_size - source.tell()
+    offset = int(offset)
+    header = _sizeheader(size) if prepend_size else b""
+    chunksize = max(cols, chunksize - chunksize % cols)
 
-    nremain = cols
+    for start, end, offsetaddress in _ihex_segments(size + len(header),
+            offset, len(header)):
+        region = _ihex_make04offset(offsetaddress)
+        if not skipblank:
+            yield region
+            region = None
+        for k in range(start, end, chunksize):
+            n = min(chunksize, end - k)
+            if k < len(header):
+                data = bytearray(header)
+                data += chunk(0, n - len(header))
+            else:
+                data = chunk(k - len(header), n)
+            if len(data) != n:
+                raise IOError("binary ended before {0} bytes".format(size))
+            for line in _ihex_encode(data, offset + k - offsetaddress, cols,
+                    skipblank):
+                if region is not None:
+                    yield region
+                    region = None
+                yield line
+    yield ":00000001FF\n"
 
-    if prepend_size:
-        size = len(page)
-        """ prepend 4 bytes for bin size """
-        values.append ( 0xFF & (size >> 24))
-        values.append ( 0xFF & (size >> 16))
-        values.append ( 0xFF & (size >> 8))
-        values.append ( 0xFF & size )
-        nremain -= 4
-
-    for k, v in enumerate(page):
-        reladdress = k + offset
-        if prepend_size:
-            reladdress += 4
-        if reladdress - offsetaddress == 0x10000:
-            # finish the current line
-            lines.append( _ihex_makeline(values) )
-            values = [0, 0, 0]
-            nremain = cols
-            # start new offset
-            offsetaddress = reladdress
-            lines.append( _ihex_make04offset(offsetaddress) )
-        if nremain == 0:
-            lines.append( _ihex_makeline(values) )
-            values = [(0xFF & ((reladdress - offsetaddress) >> 8)),
-                    (0xFF & (reladdress - offsetaddress)), 0]
-            nremain = cols
-        values.append( ord(v) )
-        nremain -= 1
-    if len(values) > 3: lines.append( _ihex_makeline(values) )
-    lines.append(":00000001FF\n")
-    with open(hexfile, 'w') as fh:
-        fh.write("\n".join(lines))
+def _regionjobs(binfile, position, length, offset, cols=16, skipblank=False,
+        header=b""):
+    """
+    split length bytes at position in binfile, placed at offset after the
+    optional header, into one job per 64K region for _encoderegion
+    a job is (binfile, position, bytes to read, header, offsetaddress,
+    16 bit address, cols, skipblank)
+    """
+    jobs = []
+    for start, end, offsetaddress in _ihex_segments(length + len(header),
+            offset, len(header)):
+        jobheader = header[start:end]
+        jobs.append((binfile, position + max(0, start - len(header)),
+            end - start - len(jobheader), jobheader, offsetaddress,
+            offset + start - offsetaddress, cols, skipblank))
+    return jobs
+
+def _encoderegion(job):
+    """
+    read and encode one job from _regionjobs, returns (offsetaddress, type
+    00 records)
+    """
+    (binfile, position, length, header, offsetaddress, address, cols,
+            skipblank) = job
+    with open(binfile, 'rb') as fh:
+        fh.seek(position)
+        data = fh.read(length)
+    if len(data) != length:
+        raise IOError("binary ended before {0} bytes".format(
+            position + length))
+    return offsetaddress, _ihex_encode(header + data, address, cols,
+            skipblank)
+
+def _iterjobs(jobs, skipblank=False, processes=None):
+    """
+    generator giving the lines of an intel hex file for jobs from
+    _regionjobs in address order, the regions are encoded by a pool of
+    processes and put back in order as they come in
+    a type 04 record is only written when the 64K region changes, with
+    skipblank not for a region with nothing else in it
+    """
+    if not jobs:
+        yield ":00000001FF\n"
+        return
+    if not 0 < jobs[0][6] <= 0xFF:
+        raise ValueError("cols must be between 1 and 255")
+    pool = multiprocessing.Pool(processes)
+    try:
+        region = None
+        for offsetaddress, lines in pool.imap(_encoderegion, jobs):
+            if skipblank and not lines:
+                continue
+            if offsetaddress != region:
+                region = offsetaddress
+                yield _ihex_make04offset(offsetaddress)
+            for line in lines:
+                yield line
+    finally:
+        pool.terminate()
+        pool.join()
+    yield ":00000001FF\n"
+
+def _writelines(fh, lines):
+    """
+    write the hex lines to fh one at a time, separated by newlines
+    """
+    sep = ""
+    for line in lines:
+        fh.write(sep)
+        fh.write(line)
+        sep = "\n"
+
+def _sizeheader(size):
+    """
+    the 4 byte, big endian size specifier used by prepend_size
+    """
+    return bytes(bytearray([0xFF & (size >> 24), 0xFF & (size >> 16),
+        0xFF & (size >> 8), 0xFF & size]))
+
+def _ihex_segments(length, offset, headerlen=0):
+    """
+    split a stream of length bytes placed at offset into 64K segments
+    returns a list of (start, end, offsetaddress) with start and end being
+    positions in the stream and offsetaddress the value for the 04 record
+
+    the size header is never split, if it straddles a 64K boundary the whole
+    stream stays in the first segment (the record addresses wrap) - this is
+    what the per-byte encoder always did
+    """
+    offsetaddress = offset - (offset % 0x10000)
+    start = 0
+    boundary = offsetaddress + 0x10000 - offset
+    if boundary < headerlen:
+        boundary = length
+    segments = []
+    while boundary < length:
+        segments.append((start, boundary, offsetaddress))
+        start = boundary
+        offsetaddress += 0x10000
+        boundary += 0x10000
+    segments.append((start, length, offsetaddress))
+    return segments
+
+def _ihex_encode(data, address, cols=16, skipblank=False):
+    """
+    return the type 00 records for a slice of data starting at the 16 bit
+    address, one record for every cols bytes
+    with skipblank the records that are all 0xFF are not returned
+
+    the slice is converted to hex in one pass and each record is cut from
+    that string, the checksum is taken over the whole record at once
+    (the low address byte stands in for the whole address, mod 0x100)
+    target is 3 MB/s of binary input on a modest desktop, the per-byte
+    version managed about 0.5 MB/s on the same machine
+    """
+    data = bytearray(data)
+    if skipblank:
+        if data.count(b"\xFF") == len(data):
+            return []
+        blank = b"\xFF" * cols
+    hexdata = binascii.hexlify(bytes(data)).upper()
+    lines = []
+    for k in range(0, len(data), cols):
+        n = min(cols, len(data) - k)
+        if skipblank and data[k:k + n] == blank[:n]:
+            continue
+        recaddress = 0xFFFF & (address + k)
+        checksum = 0xFF & -(n + (recaddress >> 8) + recaddress +
+                sum(data[k:k + n]))
+        lines.append( b":%02X%04X00%s%02X" % (n, recaddress,
+            hexdata[2 * k : 2 * (k + n)], checksum) )
+    return lines
 
 def _ihex_make04offset(offset):
     """
@@ -102,6 +380,178 @@ def _ihex_makeline(values):
         line.append( "{0:0>2X}".format(v) )
     return( "".join(line) )
 
+def readhex(hexfile):
+    """
+    read an intel hex file and return its data as a sorted list of
+    (address, bytearray) segments, see parsehex
+    """
+    with open(hexfile, 'rb') as fh:
+        text = fh.read()
+    return parsehex(text)
+
+def parsehex(text):
+    """
+    parse the text of an intel hex file into a sorted list of
+    (address, bytearray) segments, records that continue where the last one
+    stopped are appended to the same bytearray
+    the whole file is unhexlified in one call and the records are cut from
+    that buffer by the length of each line
+    every record checksum is checked, a ValueError is raised for any bad
+    record or for data that overlaps with different bytes
+    """
+    lines = text.split()
+    try:
+        records = bytearray(binascii.unhexlify(b"".join(
+            line[1:] for line in lines)))
+    except (TypeError, binascii.Error):
+        raise ValueError("not an intel hex file")
+
+    segments = []
+    base = 0
+    nextaddress = None
+    current = None
+    pos = 0
+    for num, line in enumerate(lines, 1):
+        if line[:1] not in (b":", ":"):
+            raise ValueError("line {0}: missing start code".format(num))
+        if not len(line) % 2:
+            raise ValueError("line {0}: bad record length".format(num))
+        end = pos + len(line) // 2
+        record = records[pos:end]
+        pos = end
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError("line {0}: bad record length".format(num))
+        if sum(record) & 0xFF:
+            raise ValueError("line {0}: bad checksum".format(num))
+
+        rtype = record[3]
+        if rtype == 0:
+            address = base + ((record[1] << 8) | record[2])
+            if address != nextaddress:
+                current = bytearray()
+                segments.append((address, current))
+            current.extend(record[4:-1])
+            nextaddress = address + record[0]
+        elif rtype == 1:
+            break
+        elif rtype == 2 and record[0] == 2:
+            base = ((record[4] << 8) | record[5]) << 4
+        elif rtype == 4 and record[0] == 2:
+            base = ((record[4] << 8) | record[5]) << 16
+        elif rtype in (3, 5):
+            continue
+        else:
+            raise ValueError("line {0}: bad record type {1:0>2X}".format(num,
+                rtype))
+    return _coalesce(segments)
+
+def verifyhex(hexfile, binfile, offset=0x80000000, prepend_size=False,
+        skipblank=False, maxdiffs=10):
+    """
+    check a hex file against the binary it was made from, as makehex would
+    have placed it at offset (with the size header if prepend_size)
+    every record checksum is checked on the way in (ValueError if one is bad)
+    returns a list of up to maxdiffs (address, expected, found) for the
+    first bytes that differ, expected or found being None where the binary
+    or the hex has no byte at that address, an empty list means they match
+    with skipblank bytes missing from the hex are fine if they are 0xFF
+    """
+    with open(binfile, 'rb') as fh:
+        expected = bytearray(fh.read())
+    if prepend_size:
+        expected[0:0] = _sizeheader(len(expected))
+    offset = int(offset)
+    end = offset + len(expected)
+
+    diffs = []
+    covered = offset
+    for address, data in readhex(hexfile):
+        if address < offset:
+            n = min(len(data), offset - address)
+            diffs.extend((address + k, None, data[k]) for k in range(min(n,
+                maxdiffs)))
+        if address > covered and covered < end:
+            _missing(diffs, expected, offset, covered, min(address, end),
+                    skipblank, maxdiffs)
+        start = max(address, offset)
+        stop = min(address + len(data), end)
+        if start < stop:
+            _comparebytes(diffs, expected[start - offset : stop - offset],
+                    data[start - address : stop - address], start, maxdiffs)
+        if address + len(data) > end:
+            first = max(address, end)
+            diffs.extend((first + k, None, data[first - address + k])
+                    for k in range(min(address + len(data) - first, maxdiffs)))
+        covered = max(covered, address + len(data))
+        if len(diffs) >= maxdiffs:
+            return sorted(diffs)[:maxdiffs]
+    if covered < end:
+        _missing(diffs, expected, offset, covered, end, skipblank, maxdiffs)
+    return sorted(diffs)[:maxdiffs]
+
+def _missing(diffs, expected, offset, start, stop, skipblank, maxdiffs):
+    """
+    add the bytes of expected from address start to stop that the hex lacks
+    """
+    gap = expected[start - offset : stop - offset]
+    if skipblank and gap.count(b"\xFF") == len(gap):
+        return
+    for k, value in enumerate(gap):
+        if len(diffs) >= maxdiffs:
+            return
+        if not (skipblank and value == 0xFF):
+            diffs.append((start + k, value, None))
+
+def _comparebytes(diffs, expected, found, address, maxdiffs, block=4096):
+    """
+    add the differences between two equal length bytearrays starting at
+    address, whole blocks are compared first so only a block that differs
+    is looked at byte by byte
+    """
+    for k in range(0, len(expected), block):
+        if expected[k:k + block] == found[k:k + block]:
+            continue
+        for i in range(k, min(k + block, len(expected))):
+            if expected[i] != found[i]:
+                diffs.append((address + i, expected[i], found[i]))
+                if len(diffs) >= maxdiffs:
+                    return
+
+def mergesegments(segments):
+    """
+    merge (address, data) segments, data being any bytes-like object, into a
+    sorted list of (address, bytearray) with the ones that touch joined
+    overlaps are fine where both hold the same bytes, otherwise a ValueError
+    is raised
+    """
+    return _coalesce([(address, bytearray(data)) for address, data in segments])
+
+def _coalesce(segments):
+    """
+    sort (address, bytearray) segments and join the ones that touch or
+    overlap with the same bytes, the bytearrays are extended in place
+    raise a ValueError if any of them overlap with different bytes
+    """
+    merged = []
+    for address, data in sorted(segments, key=lambda s: s[0]):
+        if not len(data):
+            continue
+        if merged:
+            last, lastdata = merged[-1]
+            end = last + len(lastdata)
+            if address < end:
+                n = min(end - address, len(data))
+                if lastdata[address - last : address - last + n] != data[:n]:
+                    raise ValueError("overlapping data at 0x{0:0>8X}".format(
+                        address))
+                lastdata.extend(data[n:])
+                continue
+            if address == end:
+                lastdata.extend(data)
+                continue
+        merged.append((address, data))
+    return merged
+
 def parseargs(args):
     """
     parse argument options
@@ -109,22 +559,28 @@ def parseargs(args):
     optional args include:
         -h {filename} : specify the hex file to create, default bin name
         -o {offset} : specify an offset, default 0x80000000
-        -c {columns} : specify number of columns, default 16
+        -c {columns} : specify number of columns (1-255), default 16
         -p : if set, hex will be prepended with a 4 byte size specifier
+        -b : if set, records that are all 0xFF (blank) are left out
+        -j {processes} : encode in that many processes, 0 for one per cpu
+        -C {directory} : use the hex cache in directory (see cache.py)
     """
     if not len(args):
-        return(False, 0,0,0,0)
+        return(False, 0,0,0,0,0,0,0,0)
 
     binfile = args[-1]
     if not os.path.exists(binfile):
         print ("binary file {0} does not exist".format(binfile))
-        return(False, 0,0,0,0)
+        return(False, 0,0,0,0,0,0,0,0)
     args = args[:-1]
 
     hexfile = None
     offset = 0x80000000
     cols = 16
     prepend_size = False
+    skipblank = False
+    processes = 1
+    cachedir = None
 
     while (len(args)):
         if args[0] == '-h':
@@ -136,9 +592,37 @@ def parseargs(args):
         elif args[0] == '-p':
             prepend_size = True
             args = args[1:]
+        elif args[0] == '-b':
+            skipblank = True
+            args = args[1:]
+        elif args[0] == '-j':
+            args, processes = _checkprocesses(args)
+        elif args[0] == '-C':
+            args, cachedir = _checkname(args)
         else:
-            return (False, 0,0,0,0)
-    return (True, binfile, hexfile, offset, cols, prepend_size)
+            return (False, 0,0,0,0,0,0,0,0)
+    return (True, binfile, hexfile, offset, cols, prepend_size, skipblank,
+            processes, cachedir)
+
+
+def runargs(args):
+    """
+    parse args (see parseargs) and make the hex they ask for, printing the
+    commands if they make no sense
+    returns True if a hex was made
+    """
+    (success, binfile, hexfile, offset, cols, prepend_size, skipblank,
+            processes, cachedir) = parseargs(args)
+    if not success:
+        printcommands()
+    elif cachedir is not None:
+        from avr32.cache import HexCache
+        HexCache(cachedir).makehex(binfile, hexfile, offset, cols,
+                prepend_size, skipblank=skipblank, processes=processes)
+    else:
+        makehex(binfile, hexfile, offset, cols, prepend_size,
+                skipblank=skipblank, processes=processes)
+    return success
 
 
 def _checkname(args):
@@ -162,29 +646,35 @@ def _checkoffset(args):
 def _checkcols(args):
     if len(args) > 1:
         cols = int(args[1])
-        if not ((cols == 16) or (cols == 32)):
-            print("cols must be 16 or 32")
+        if not (0 < cols <= 0xFF):
+            print("cols must be between 1 and 255")
             return(['X'], None)
         return(args[2:], cols)
     else:
         return(['X'], None)
 
+def _checkprocesses(args):
+    if len(args) > 1:
+        processes = int(args[1])
+        if processes < 0:
+            print("processes must be 0 or more")
+            return(['X'], None)
+        return(args[2:], processes or None)
+    else:
+        return(['X'], None)
+
 def printcommands():
     print("makehex [optional args] {binary filename}")
     print("arg format options:")
     print("\t-h {filename} : specify the hex file to create, default bin name")
     print("\t-o {offset} : specify an offset, default 0x80000000")
-    print("\t-c {columns} : specify number of columns, default 16")
+    print("\t-c {columns} : specify number of columns (1-255), default 16")
     print("\t-p : if set, hex will be prepended with a 4-byte specifier")
+    print("\t-b : if set, records that are all 0xFF (blank) are left out")
+    print("\t-j {processes} : encode in that many processes, 0 for one per cpu")
+    print("\t-C {directory} : use the hex cache in directory")
 
 
 if __name__=="__main__":
     log.basicConfig(level=log.DEBUG)
-    if len(sys.argv) > 1:
-        success, binfile, hexfile, offset, cols, prepend_size = parseargs(sys.argv[1:])
-        if success:
-            makehex(binfile, hexfile, offset, cols, prepend_size)
-        else:
-            printcommands()
-    else:
-        printcommands()
+    runargs(sys.argv[1:])
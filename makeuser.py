@@ -24,17 +24,30 @@ from future_builtins import (ascii, filter, hex, map, oct, zip)
 import logging as log
 import sys
 import os
-from avr32.makehex import makehex
-
+import multiprocessing
+import zipfile
+import struct
+import csv
+import json
+from avr32.makehex import bin2hex, readhex
+from avr32.crc import getCRC8, cfgword, MAGIC
+
+# layout of a user page: serial number and filler, cfg word, crc
+PAGE = struct.Struct(b">508s3sB")
+# the columns of the table decodeuserfiles and writetable make
+PAGE_COLUMNS = ["file", "serial", "filler_ok", "cfg", "pin", "pinhigh",
+        "crc_ok", "error"]
 
 # TODO : implement arg parse for -sn, -pin, -phigh, -fn, -bin
 
 
-def makeuser(serialnum="", pin=5, pinhigh=False, filename=None, keepbin=False):
+def makeuser(serialnum="", pin=5, pinhigh=False, filename=None, keepbin=False,
+        cache=None):
     """
     puts the value for word in the last 4 bytes of the 512 byte user page
     puts the value for the serial number in the first x bytes of the user page
-    filename.bin and filename.hex will be created.
+    filename.hex will be created, filename.bin only if keepbin is set
+    cache is an optional cache.HexCache the hex is made through
 
     the default (shipped) value for the boot select pin is 0x0D (pin A13)
     """
@@ -42,14 +55,35 @@ def makeuser(serialnum="", pin=5, pinhigh=False, filename=None, keepbin=False):
     if filename is None:
         filename = serialnum if serialnum != "" else "userpage"
 
+    page = makepage(serialnum, pin, pinhigh)
+
+    if keepbin:
+        with open(".".join([filename, "bin"]), 'wb') as fh:
+            fh.write(page)
+
+    with open(".".join([filename, "hex"]), 'w') as fh:
+        if cache is not None:
+            fh.write(cache.bin2hex(page, 0x80800000))
+        else:
+            fh.write(bin2hex(page, 0x80800000))
+
+def makeuserhex(serialnum="", pin=5, pinhigh=False):
+    """
+    return the text of the user page hex file, nothing is written to disk
+    """
+    return _userhex(makepage(serialnum, pin, pinhigh))
+
+def makepage(serialnum="", pin=5, pinhigh=False):
+    """
+    return the 512 byte user page as a bytearray
+    the serial number is NUL terminated at the start of the page and the cfg
+    word for pin is in the last 4 bytes (none if pin is None)
+    """
     # init the page
     page = bytearray([0xFF] * 512)
 
     # add the serial number
-    for i, c in enumerate(list(serialnum)):
-        page[i] = c
-    if len(serialnum):
-        page[i+1] = 0
+    _patchserial(page, serialnum)
 
     # add bootloader configuration word
     if pin is not None:
@@ -59,32 +93,108 @@ def makeuser(serialnum="", pin=5, pinhigh=False, filename=None, keepbin=False):
         for i, b in enumerate(revword):
             page[-1 - i] = b
 
-    binfn = ".".join([filename, "bin"])
-    hexfn = ".".join([filename, "hex"])
+    return page
 
-    with open(binfn, 'wb') as fh:
-        fh.write(page)
+def _patchserial(page, serialnum):
+    """
+    write the NUL terminated serial number over the start of the page
+    """
+    if len(serialnum):
+        page[:len(serialnum)] = serialnum.encode('ascii')
+        page[len(serialnum)] = 0
 
-    makehex(binfn, hexfn, 0x80800000)
+def makeusers(serialnums, pin=5, pinhigh=False, directory=".", archive=None,
+        processes=None, cache=None):
+    """
+    make the user page hex for many serial numbers at once
+    serialnums is an iterable of serial numbers or the name of a file with
+    one serial number per line
+    the page and cfg word are made once and only the serial number is
+    patched in for each unit, the hex encoding is spread over a pool of
+    processes (processes=1 does it all in this one)
+    writes directory/{serial number}.hex for each unit, or if archive is
+    given a single zip file holding them
+    with cache (a cache.HexCache) the pages found in it are not encoded again
+    and the rest are added to it
+    returns the list of files written
+    """
+    if isinstance(serialnums, basestring):
+        with open(serialnums, 'r') as fh:
+            serialnums = [line.strip() for line in fh if line.strip()]
+    serialnums = list(serialnums)
+    pages = [page for serialnum, page in userpages(serialnums, pin, pinhigh)]
+
+    hexes = [None] * len(pages)
+    if cache is not None:
+        keys = [cache.bin2hexkey(page, 0x80800000) for page in pages]
+        hexes = [cache.get(key) for key in keys]
+    missing = [k for k, text in enumerate(hexes) if text is None]
+
+    if processes == 1 or not missing:
+        made = [_userhex(pages[k]) for k in missing]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            made = pool.map(_userhex, [pages[k] for k in missing],
+                    chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+    for k, text in zip(missing, made):
+        hexes[k] = text
+        if cache is not None:
+            cache.put(keys[k], text)
+
+    names = ["{0}.hex".format(serialnum) for serialnum in serialnums]
+    if archive is not None:
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, text in zip(names, hexes):
+                zf.writestr(name, text)
+        return [archive]
+
+    written = []
+    for name, text in zip(names, hexes):
+        name = os.path.join(directory, name)
+        with open(name, 'w') as fh:
+            fh.write(text)
+        written.append(name)
+    return written
+
+def userpages(serialnums, pin=5, pinhigh=False):
+    """
+    generator giving (serial number, user page) for each of serialnums, the
+    page and cfg word are made once and only the serial number is patched
+    in for each, nothing is read from serialnums before it is needed
+    """
+    template = None
+    for serialnum in serialnums:
+        if template is None:
+            template = makepage("", pin, pinhigh)
+        page = bytearray(template)
+        _patchserial(page, serialnum)
+        yield serialnum, page
+
+def userhexes(serialnums, pin=5, pinhigh=False):
+    """
+    generator giving (serial number, user page hex text) for each of
+    serialnums, see userpages
+    """
+    for serialnum, page in userpages(serialnums, pin, pinhigh):
+        yield serialnum, _userhex(page)
 
-    if not keepbin:
-        os.remove(binfn)
+def _userhex(page):
+    """ hex text for a user page, module level so the pool can pickle it """
+    return bin2hex(page, 0x80800000)
 
 def _makeCFGWord(pin=5, pinhigh=False):
     """ make the cfg word, including a checksum based on a certain pin number and
     pin condition
     returns the word as a list with 4 byte values
     """
-    magic = 0x494F
-    pval = 1 if pinhigh else 0
-    word3 = ((magic<<17) + (pval<<16) + (pin<<8))>>8
-    print ("First 3 bytes: 0x{0:0>6X}".format(word3))
-    crc8 = _getCRC8(word3)
-    print ("Checksum (CRC8): 0x{0:0>2X}".format(crc8))
-    word = (word3<<8) + crc8
-    whex = "{0:0>8X}".format(word)
-    print ("Word is: 0x{0}".format(whex))
-    wvals = [int(whex[2 * i : 2 * i + 2], 16) for i in range(4)]
+    wvals = cfgword(pin, pinhigh)
+    print ("First 3 bytes: 0x{0:0>2X}{1:0>2X}{2:0>2X}".format(*wvals))
+    print ("Checksum (CRC8): 0x{0:0>2X}".format(wvals[3]))
+    print ("Word is: 0x{0:0>2X}{1:0>2X}{2:0>2X}{3:0>2X}".format(*wvals))
     return wvals
 
 def _parseCFGword(filename="ispcfg.bin", display=True):
@@ -102,35 +212,93 @@ def _parseCFGword(filename="ispcfg.bin", display=True):
         print("IO Condition: Pin {0} {1}".format(pin, "High" if val else "Low"))
     return(values)
 
-def _getCRC8(word3):
+# serial number and filler, first 3 bytes of the cfg word, cfg word crc
+def decodepage(page):
     """
-    calculate one byte cyclic redundancy check
-
-    C(x) = x^8 + x^2 + x^1 + x^0 == 1 0 0 0 0 0 1 1 1
-
-    from: http://ghsi.de/CRC/index.php?Polynom=100000111&Message=929E05
-    // ========================================================================
-    // CRC Generation Unit - Linear Feedback Shift Register implementation
-    // (c) Kay Gorontzi, GHSi.de, distributed under the terms of LGPL
-    // ========================================================================
+    decode a 512 byte user page as makeuser writes it
+    returns a dict with the serial number, whether everything after it up to
+    the cfg word is 0xFF (filler_ok), whether there is a cfg word (cfg),
+    and if there is its pin, pin condition and whether the crc matches
+    """
+    body, word3, crc = PAGE.unpack(bytes(page))
+    body = bytearray(body)
+    end = body.find(b"\x00")
+    if body[0] == 0xFF or end < 0:
+        serial, end = "", 0
+    else:
+        serial = body[:end].decode('ascii', 'replace')
+        end += 1
+    row = {"serial": serial,
+            "filler_ok": body.count(b"\xFF", end) == len(body) - end,
+            "cfg": False, "pin": None, "pinhigh": None, "crc_ok": None}
+    word3 = bytearray(word3)
+    if word3 != bytearray(b"\xFF\xFF\xFF") or crc != 0xFF:
+        value = (word3[0] << 16) | (word3[1] << 8) | word3[2]
+        row.update({"cfg": (value >> 9) == MAGIC, "pin": word3[2],
+            "pinhigh": bool(word3[1] & 1), "crc_ok": getCRC8(value) == crc})
+    return row
+
+def decodeuserfiles(filenames, processes=None):
     """
-    crc = [0, 0, 0, 0, 0, 0, 0, 0]
-    binstr = [int(b) for b in list("{0:b}".format(word3))]
-    for v in binstr:
-        doinvert = v ^ crc[7]
-        crc[7] = crc[6]
-        crc[6] = crc[5]
-        crc[5] = crc[4]
-        crc[4] = crc[3]
-        crc[3] = crc[2]
-        crc[2] = crc[1] ^ doinvert
-        crc[1] = crc[0] ^ doinvert
-        crc[0] = doinvert
-    return sum([c*2**i for i, c in enumerate(crc)])
+    decode user page dumps (.bin, or .hex at 0x80800000) with a pool of
+    processes (processes=1 does them all in this one)
+    returns a list of dicts as decodepage, with the file name and an error
+    message for files that could not be read
+    """
+    filenames = list(filenames)
+    if processes == 1:
+        return [_decodefile(name) for name in filenames]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_decodefile, filenames, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+
+def _decodefile(filename):
+    """ decode one dump for decodeuserfiles """
+    try:
+        if os.path.splitext(filename)[1].lower() == ".hex":
+            page = bytearray([0xFF] * 512)
+            for address, data in readhex(filename):
+                k = address - 0x80800000
+                if k < 0 or k + len(data) > 512:
+                    raise ValueError("data outside of the user page")
+                page[k:k + len(data)] = data
+        else:
+            with open(filename, 'rb') as fh:
+                page = fh.read()
+            if len(page) != 512:
+                raise ValueError("user page should be 512 bytes")
+        row = decodepage(page)
+        row["error"] = ""
+    except (IOError, ValueError) as e:
+        row = dict((column, None) for column in PAGE_COLUMNS)
+        row["error"] = str(e)
+    row["file"] = filename
+    return row
+
+def writetable(rows, filename):
+    """
+    write decoded pages as csv, or as json if filename ends in .json
+    """
+    if filename.lower().endswith(".json"):
+        with open(filename, 'w') as fh:
+            json.dump(rows, fh, indent=1, sort_keys=True)
+        return
+    with open(filename, 'wb') as fh:
+        writer = csv.writer(fh)
+        writer.writerow([column.encode('ascii') for column in PAGE_COLUMNS])
+        for row in rows:
+            writer.writerow(["" if row[column] is None else
+                unicode(row[column]).encode('utf-8')
+                for column in PAGE_COLUMNS])
 
 def parseargs(args):
     """
-    parse argument options -b, -sn, -p, -f, -kb
+    parse argument options -b, -sn, -p, -f, -kb, -sf, -d, -C
+    returns (success, serial number, pin, pin high, filename, keep binary,
+    serial number file, table, dumps, cache directory)
     """
     b = False
     sn = ""
@@ -138,15 +306,29 @@ def parseargs(args):
     phigh = False
     fn = None
     keepbin = False
+    serialfile = None
+    table = None
+    dumps = []
+    cachedir = None
+
+    if '-C' in args[:-1]:
+        k = args.index('-C')
+        cachedir = args[k + 1]
+        args = args[:k] + args[k + 2:]
+
+    if not len(args):
+        return(False, 0,0,0,0,0,0,0,0,0)
 
     if args[0] == "-b":
         if len(args) == 1:
-            return(True, sn, None, phigh, fn, keepbin)
+            return(True, sn, None, phigh, fn, keepbin, serialfile, table,
+                    dumps, cachedir)
         elif len(args) == 3 and args[1] == '-f':
             fn = args[2]
-            return(True, sn, p, phigh, fn)
+            return(True, sn, p, phigh, fn, keepbin, serialfile, table, dumps,
+                    cachedir)
         else:
-            return(False, 0,0,0,0,0)
+            return(False, 0,0,0,0,0,0,0,0,0)
 
     while (len(args)):
         if args[0] == '-sn':
@@ -158,9 +340,38 @@ def parseargs(args):
         elif args[0] == '-kb':
             args = args[1:]
             keepbin = True
+        elif args[0] == '-sf':
+            args, serialfile = _checkname(args)
+        elif args[0] == '-d' and len(args) > 2:
+            table = args[1]
+            dumps = args[2:]
+            args = []
         else:
-            return (False, 0,0,0,0,0)
-    return (True, sn, p, phigh, fn, keepbin)
+            return (False, 0,0,0,0,0,0,0,0,0)
+    return (True, sn, p, phigh, fn, keepbin, serialfile, table, dumps,
+            cachedir)
+
+def runargs(args):
+    """
+    parse args (see parseargs) and do what they ask, printing the commands
+    if they make no sense
+    returns True if something was done
+    """
+    (success, sn, p, phigh, fn, keepbin, serialfile, table, dumps,
+            cachedir) = parseargs(args)
+    cache = None
+    if success and cachedir is not None:
+        from avr32.cache import HexCache
+        cache = HexCache(cachedir)
+    if not success:
+        printcommands()
+    elif dumps:
+        writetable(decodeuserfiles(dumps), table)
+    elif serialfile is not None:
+        makeusers(serialfile, p, phigh, cache=cache)
+    else:
+        makeuser(sn, p, phigh, fn, keepbin, cache)
+    return success
 
 def _checkname(args):
     if len(args) > 1:
@@ -183,15 +394,12 @@ def printcommands():
     print("\t-b : for blank userpage")
     print("\t-f {filename} : specify filename - noextension")
     print("\t-kb : specify to keep binary intermediate")
+    print("\t-sf {filename} : make one hex per serial number in the file,")
+    print("\t\twith -p for the pin")
+    print("\t-d {table} {dumps...} : decode user page dumps to a csv/json table")
+    print("\t-C {directory} : use the hex cache in directory")
 
 
 if __name__=="__main__":
     log.basicConfig(level=log.DEBUG)
-    if len(sys.argv) > 1:
-        success, sn, pin, high, fn, keepbin = parseargs(sys.argv[1:])
-        if success:
-            makeuser(sn, pin, high, fn, keepbin)
-        else:
-            printcommands()
-    else:
-        printcommands()
+    runargs(sys.argv[1:])
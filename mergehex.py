@@ -0,0 +1,290 @@
+""""
+merge intel hex files, ie a base firmware with calibration data or the user
+pages made by makeuser laid over it
+
+$ python mergehex.py [-h {hex out}] [-e] [-c {columns}] {base} {overlays...}
+$ python mergehex.py -u {directory} [-e] [-c {columns}] {base} {overlays...}
+
+the data is kept as a sorted list of segments that is searched by address,
+so adding a segment only looks at the ones it lands on and the overlaps are
+found in O(n log n) for n segments
+later files win where they overlap earlier ones, or with -e any overlap
+with different bytes is an error
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future_builtins import (ascii, filter, hex, map, oct, zip)
+
+import logging as log
+import sys
+import os
+import bisect
+from avr32.makehex import readhex, _ihex_encode, _ihex_make04offset
+
+POLICIES = ("later", "error")
+
+
+class HexIndex(object):
+    """
+    memory image made of sorted segments that do not overlap,
+    starts holds the address and datas the bytearray of each
+    policy is what add does with an overlap, later: the new bytes win,
+    error: a ValueError if the bytes differ
+    """
+
+    def __init__(self, segments=(), policy="later"):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of {0}".format(
+                ", ".join(POLICIES)))
+        self.policy = policy
+        self.starts = []
+        self.datas = []
+        for address, data in segments:
+            self.add(address, data)
+
+    def add(self, address, data):
+        """
+        lay data (bytes-like) over the image at address
+        """
+        if not len(data):
+            return
+        end = address + len(data)
+        # the segments from first to last overlap or touch address:end
+        first = bisect.bisect_right(self.starts, address) - 1
+        if first < 0 or self.starts[first] + len(self.datas[first]) < address:
+            first += 1
+        last = bisect.bisect_right(self.starts, end)
+
+        if self.policy == "error":
+            for k in range(first, last):
+                start, old = self.starts[k], self.datas[k]
+                lo, hi = max(start, address), min(start + len(old), end)
+                if (lo < hi and old[lo - start : hi - start] !=
+                        data[lo - address : hi - address]):
+                    raise ValueError("overlapping data at 0x{0:0>8X}".format(
+                        lo))
+
+        if last - first == 1:
+            start, old = self.starts[first], self.datas[first]
+            if start <= address and end <= start + len(old):
+                old[address - start : end - start] = data
+                return
+
+        merged = bytearray()
+        newstart = address
+        if first < last and self.starts[first] < address:
+            newstart = self.starts[first]
+            merged += self.datas[first][:address - newstart]
+        merged += data
+        if first < last:
+            start, old = self.starts[last - 1], self.datas[last - 1]
+            if start + len(old) > end:
+                merged += old[end - start:]
+        self.starts[first:last] = [newstart]
+        self.datas[first:last] = [merged]
+
+    def segments(self):
+        """
+        return the image as a sorted list of (address, bytearray)
+        """
+        return list(zip(self.starts, self.datas))
+
+    def regions(self):
+        """
+        return the sorted list of 64K regions (their 04 record address) that
+        hold any data
+        """
+        found = []
+        for start, data in zip(self.starts, self.datas):
+            first = start - start % 0x10000
+            for region in range(first, start + len(data), 0x10000):
+                if not found or found[-1] != region:
+                    found.append(region)
+        return found
+
+    def window(self, start, end):
+        """
+        return a new HexIndex with a copy of the data from start to end
+        """
+        index = HexIndex(policy=self.policy)
+        k = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while k < len(self.starts) and self.starts[k] < end:
+            address, data = self.starts[k], self.datas[k]
+            lo, hi = max(address, start), min(address + len(data), end)
+            if lo < hi:
+                index.starts.append(lo)
+                index.datas.append(data[lo - address : hi - address])
+            k += 1
+        return index
+
+    def encoderegion(self, region, cols=16, skipblank=False):
+        """
+        return the type 00 records for the data in the 64K region
+        """
+        if not 0 < cols <= 0xFF:
+            raise ValueError("cols must be between 1 and 255")
+        lines = []
+        end = region + 0x10000
+        k = max(0, bisect.bisect_right(self.starts, region) - 1)
+        while k < len(self.starts) and self.starts[k] < end:
+            address, data = self.starts[k], self.datas[k]
+            lo, hi = max(address, region), min(address + len(data), end)
+            if lo < hi:
+                lines.extend(_ihex_encode(data[lo - address : hi - address],
+                    lo - region, cols, skipblank))
+            k += 1
+        return lines
+
+    def tohex(self, cols=16, skipblank=False):
+        """
+        return the text of an intel hex file for the image, the same as
+        makehex.segments2hex gives for segments()
+        """
+        return _hextext((region, self.encoderegion(region, cols, skipblank))
+                for region in self.regions())
+
+
+def _hextext(regions):
+    """
+    join (region, records) in address order into the text of a hex file, a
+    region without records is left out
+    """
+    lines = []
+    for region, records in regions:
+        if records:
+            lines.append(_ihex_make04offset(region))
+            lines.extend(records)
+    lines.append(":00000001FF\n")
+    return "\n".join(lines)
+
+
+def mergehex(hexfiles, hexfile="merged.hex", policy="later", cols=16,
+        skipblank=False):
+    """
+    merge hexfiles in order into hexfile
+    later files win where they overlap, unless policy is error
+    returns the HexIndex of the merged image
+    """
+    index = HexIndex(policy=policy)
+    for name in hexfiles:
+        for address, data in readhex(name):
+            try:
+                index.add(address, data)
+            except ValueError as e:
+                raise ValueError("{0}: {1}".format(name, e))
+    with open(hexfile, 'w') as fh:
+        fh.write(index.tohex(cols, skipblank))
+    return index
+
+def mergeunits(basefile, overlays, directory=".", policy="later", cols=16,
+        skipblank=False):
+    """
+    merge each of overlays (ie per unit user pages) with basefile on its own
+    and write it to directory under the overlay's file name
+    the base is read and encoded once, for each unit only the 64K regions
+    its overlay lands on are copied and encoded again
+    a ValueError is raised before anything is written if an output would
+    replace the base, an overlay or another output
+    returns the list of files written
+    """
+    overlays = list(overlays)
+    outfiles = [os.path.join(directory, os.path.basename(name))
+            for name in overlays]
+    inputs = set(os.path.realpath(name) for name in [basefile] + overlays)
+    seen = set()
+    for outfile in outfiles:
+        path = os.path.realpath(outfile)
+        if path in inputs or path in seen:
+            raise ValueError("{0} would be overwritten, use another "
+                    "directory".format(outfile))
+        seen.add(path)
+
+    base = HexIndex(readhex(basefile), policy)
+    encoded = dict((region, base.encoderegion(region, cols, skipblank))
+            for region in base.regions())
+
+    written = []
+    for name, outfile in zip(overlays, outfiles):
+        segments = readhex(name)
+        touched = set()
+        for address, data in segments:
+            first = address - address % 0x10000
+            touched.update(range(first, address + len(data), 0x10000))
+        unit = HexIndex(policy=policy)
+        for region in sorted(touched):
+            window = base.window(region, region + 0x10000)
+            unit.starts.extend(window.starts)
+            unit.datas.extend(window.datas)
+        for address, data in segments:
+            try:
+                unit.add(address, data)
+            except ValueError as e:
+                raise ValueError("{0}: {1}".format(name, e))
+
+        records = dict(encoded)
+        for region in touched:
+            records[region] = unit.encoderegion(region, cols, skipblank)
+        with open(outfile, 'w') as fh:
+            fh.write(_hextext(sorted(records.items())))
+        written.append(outfile)
+    return written
+
+def parseargs(args):
+    """
+    parse argument options -h, -u, -e, -c
+    returns (success, hexfiles, hex out, unit directory, policy, cols)
+    """
+    hexfile = "merged.hex"
+    directory = None
+    policy = "later"
+    cols = 16
+    while len(args) and args[0].startswith('-'):
+        if args[0] == '-h' and len(args) > 1:
+            hexfile = args[1]
+            args = args[2:]
+        elif args[0] == '-u' and len(args) > 1:
+            directory = args[1]
+            args = args[2:]
+        elif args[0] == '-e':
+            policy = "error"
+            args = args[1:]
+        elif args[0] == '-c' and len(args) > 1:
+            cols = int(args[1])
+            if not 0 < cols <= 0xFF:
+                print("cols must be between 1 and 255")
+                return (False, 0,0,0,0,0)
+            args = args[2:]
+        else:
+            return (False, 0,0,0,0,0)
+    if len(args) < 2:
+        return (False, 0,0,0,0,0)
+    for name in args:
+        if not os.path.exists(name):
+            print("hex file {0} does not exist".format(name))
+            return (False, 0,0,0,0,0)
+    return (True, args, hexfile, directory, policy, cols)
+
+def printcommands():
+    print("mergehex [optional args] {base hex} {overlay hexes...}")
+    print("arg format options:")
+    print("\t-h {filename} : the merged hex to create, default merged.hex")
+    print("\t-u {directory} : merge each overlay with the base on its own,")
+    print("\t\twritten to directory under the overlay's name")
+    print("\t-e : overlaps with different bytes are an error, default is")
+    print("\t\tthat later files win")
+    print("\t-c {columns} : specify number of columns (1-255), default 16")
+
+
+if __name__=="__main__":
+    log.basicConfig(level=log.DEBUG)
+    success, hexfiles, hexfile, directory, policy, cols = parseargs(
+            sys.argv[1:])
+    if success and directory is not None:
+        mergeunits(hexfiles[0], hexfiles[1:], directory, policy, cols)
+    elif success:
+        mergehex(hexfiles, hexfile, policy, cols)
+    else:
+        printcommands()
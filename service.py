@@ -0,0 +1,169 @@
+""""
+a resident service that keeps makehex and makeuser loaded, so calling them
+once per board does not pay for starting python and importing them each time
+
+start it once, optionally with a hex cache (see cache.py):
+$ python service.py serve [-C {cache directory}] [socket]
+
+then use the client the same way as the scripts, with the same options:
+$ sh avr32hex.sh makehex [makehex options] {binary filename}
+$ sh avr32hex.sh makeuser [makeuser options]
+
+avr32hex.sh talks to the service with socat so no python is started for a
+job, without socat or a running service it falls back to the python client
+$ python service.py makehex|makeuser [options]
+which does the same but still pays for starting python each call (it is
+only a little faster than the script itself)
+
+a job is one json line {"tool", "args", "cwd"} and the reply one json line
+{"status", "output"}, or with "raw" set in the job a line with the exit
+status followed by the output as it is
+the job runs in the client's working directory and anything it prints is
+sent back to the client, if no service is running the client does the job
+itself
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future_builtins import (ascii, filter, hex, map, oct, zip)
+
+import logging as log
+import sys
+import os
+import json
+import socket
+import tempfile
+
+# the same default as avr32hex.sh, AVR32HEX_SOCK changes it for both
+SOCKET = os.environ.get("AVR32HEX_SOCK",
+        os.path.join(tempfile.gettempdir(), "avr32hex.sock"))
+
+
+def serve(path=SOCKET, cachedir=None):
+    """
+    answer jobs on the unix socket at path until interrupted
+    jobs are run one at a time
+    with cachedir the jobs that do not give -C use the hex cache there
+    """
+    if cachedir is not None:
+        cachedir = os.path.abspath(os.path.expanduser(cachedir))
+    import SocketServer
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line.strip():
+                return
+            request = json.loads(line)
+            args = request["args"]
+            if cachedir is not None and "-C" not in args:
+                args = ["-C", cachedir] + args
+            status, output = _runjob(request["tool"], args, request["cwd"])
+            if request.get("raw"):
+                if isinstance(output, unicode):
+                    output = output.encode('utf-8')
+                self.wfile.write("{0}\n".format(status).encode('ascii') +
+                        output)
+            else:
+                self.wfile.write(json.dumps({"status": status,
+                    "output": output}).encode('utf-8') + b"\n")
+
+    if os.path.exists(path):
+        if _answers(path):
+            raise IOError("a service is already running on {0}".format(path))
+        os.remove(path)
+    server = SocketServer.UnixStreamServer(path, Handler)
+    log.info("serving on {0}".format(path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def client(tool, args, path=SOCKET):
+    """
+    send a makehex or makeuser job (args as for the script) to the service
+    prints what the job printed and returns its exit status
+    """
+    request = {"tool": tool, "args": list(args), "cwd": os.getcwd()}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        status, output = _runjob(tool, args, os.getcwd())
+    else:
+        try:
+            sock.sendall(json.dumps(request).encode('utf-8') + b"\n")
+            reply = json.loads(sock.makefile('rb').readline())
+        finally:
+            sock.close()
+        status, output = reply["status"], reply["output"]
+    sys.stdout.write(output)
+    return status
+
+def _answers(path):
+    """
+    True if something accepts connections on the unix socket at path
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def _runjob(tool, args, cwd):
+    """
+    run one job in cwd, returns (exit status, printed output)
+    """
+    from StringIO import StringIO
+    from avr32 import makehex, makeuser
+
+    stdout = sys.stdout
+    olddir = os.getcwd()
+    sys.stdout = StringIO()
+    status = 0
+    try:
+        os.chdir(cwd)
+        if tool == "makehex":
+            if not makehex.runargs(args):
+                status = 1
+        elif tool == "makeuser":
+            if not makeuser.runargs(args):
+                status = 1
+        else:
+            print("unknown tool {0}".format(tool))
+            status = 1
+    except Exception as e:
+        print("{0}: {1}".format(type(e).__name__, e))
+        status = 1
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+        os.chdir(olddir)
+    return status, output
+
+def printcommands():
+    print("service serve [-C {cache directory}] [socket]")
+    print("service makehex [makehex options] {binary filename}")
+    print("service makeuser [makeuser options]")
+
+
+if __name__=="__main__":
+    log.basicConfig(level=log.DEBUG)
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        args = sys.argv[2:]
+        cachedir = None
+        if args[:1] == ["-C"] and len(args) > 1:
+            cachedir = args[1]
+            args = args[2:]
+        serve(*args[:1], cachedir=cachedir)
+    elif len(sys.argv) > 1 and sys.argv[1] in ("makehex", "makeuser"):
+        sys.exit(client(sys.argv[1], sys.argv[2:]))
+    else:
+        printcommands()
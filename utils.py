@@ -14,28 +14,295 @@ from future_builtins import (ascii, filter, hex, map, oct, zip)
 import logging as log
 import sys
 import os
-from subprocess import call
+from subprocess import call, Popen, PIPE, STDOUT
 import time
-
-
-def reloadBootloader():
+import json
+import hashlib
+import tempfile
+import threading
+import traceback
+import re
+import Queue
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from avr32.makehex import readhex, segments2hex, mergesegments
+from avr32.crc import getCRC8, cfgword
+from avr32.makeuser import userhexes
+
+# probe and log file of the target a programming thread is working on
+_target = threading.local()
+# device state snapshots by probe, see devicestate
+_snapshots = {}
+# helpers that write to the target, running one drops its snapshot
+WRITESTEPS = frozenset(["programBatchisp", "chiperase", "flashBootloader",
+    "flashCFGword", "flashuser", "flashchanged", "flashimage", "writefuses"])
+# name, first bit and width of each field of the general purpose fuses,
+# see writefuses and decodefuses
+FUSE_FIELDS = [("LOCK", 0, 16), ("EPFL", 16, 1), ("BOOTPROT", 17, 3),
+        ("BODLEVEL", 20, 6), ("BODHYST", 26, 1), ("BODEN", 27, 2),
+        ("ISP_BOD_EN", 29, 1), ("ISP_IO_COND_EN", 30, 1), ("ISP_FORCE", 31, 1)]
+# where records of programmer commands go, see settelemetry
+_telemetry = {"file": None, "hook": None}
+_telemetrylock = threading.Lock()
+# held while a flashchanged statefile is read or rewritten
+_statelock = threading.Lock()
+# probes written to by a helper other than flashchanged since their last
+# flashchanged, and the (statefile, device) each last ran flashchanged with
+_written = set()
+_flashdevices = {}
+
+def reloadBootloader(timeout=10.0):
     """
     use this to perform all necessary steps for reprogramming the bootloader
-    """
-    print("********************* C H I P   E R A S E *********************")
-    chiperase()
-    time.sleep(1.5)
-    print("********************* B O O T L O A D E R *********************")
-    flashBootloader()
-    time.sleep(1.5)
-    print("********************* C O N F I G U R A T I O N *********************")
-    flashCFGword()
-    time.sleep(1.5)
-    print("********************* F U S E S *********************")
-    writefuses()
-    time.sleep(1.5)
-    print("********************* R U N   P R O G *********************")
-    runprogram()
+    between steps the target is polled until it answers again (see waitready)
+    stops at the first step that fails or a target that does not come back
+    within timeout seconds
+    returns True if every step succeeded
+    """
+    steps = [("C H I P   E R A S E", chiperase),
+            ("B O O T L O A D E R", flashBootloader),
+            ("C O N F I G U R A T I O N", flashCFGword),
+            ("F U S E S", writefuses),
+            ("R U N   P R O G", runprogram)]
+    for k, (name, step) in enumerate(steps):
+        _say("********************* {0} *********************".format(name))
+        start = time.time()
+        result = step()
+        if result:
+            _say("{0} failed with exit code {1}".format(step.__name__, result))
+            return False
+        if k < len(steps) - 1 and not waitready(timeout):
+            _say("target not ready {0} s after {1}".format(timeout,
+                step.__name__))
+            return False
+        _say("{0} took {1:.2f} s".format(step.__name__, time.time() - start))
+    return True
+
+def waitready(timeout=10.0, interval=0.05, maxinterval=1.0):
+    """
+    poll avr32program status until the target answers
+    the wait between polls starts at interval and doubles up to maxinterval
+    returns True once the target answers, False if timeout seconds pass first
+    """
+    deadline = time.time() + timeout
+    command = _command(["avr32program", "status"])
+    with open(os.devnull, 'w') as null:
+        while True:
+            if call(command, stdout=null, stderr=null) == 0:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(2 * interval, maxinterval)
+
+def programmany(probes, sequence=reloadBootloader, processes=None, logdir="."):
+    """
+    run sequence on the target behind each probe at the same time
+    probes are avr32program cable names, ie USB:0700000A1234
+    sequence is called with no arguments in a thread per probe (at most
+    processes at once, default all of them) and should return True when
+    it succeeds - every helper in here talks to that thread's probe and the
+    output goes to logdir/{probe}.log
+    batchisp has no way to pick a device so programBatchisp can't be used
+    returns a list of (probe, success, seconds, logfile) in the order of probes
+    """
+    if not probes:
+        return []
+    pool = ThreadPool(processes or len(probes))
+    try:
+        return pool.map(partial(_programone, sequence=sequence, logdir=logdir),
+                probes)
+    finally:
+        pool.close()
+        pool.join()
+
+def _programone(probe, sequence, logdir):
+    """ run sequence for one probe, see programmany """
+    logfile = os.path.join(logdir, "{0}.log".format(probe.replace(":", "_")))
+    start = time.time()
+    with open(logfile, 'w') as fh:
+        _target.probe = probe
+        _target.out = fh
+        try:
+            success = bool(sequence())
+        except Exception:
+            fh.write(traceback.format_exc())
+            success = False
+        finally:
+            _target.probe = None
+            _target.out = None
+    return (probe, success, time.time() - start, logfile)
+
+def provision(serialnums, pin=5, pinhigh=False, directory=".", depth=2,
+        timeout=10.0, nextboard=None, cancel=None):
+    """
+    flash the user page and start the program on one board after another,
+    while a board is being flashed the user page hex of the ones after it
+    is made in a second thread, at most depth of them ahead
+    serialnums is an iterable of serial numbers, the hex for each is
+    written to directory/{serial number}.hex
+    nextboard(serialnum) is called before each board is flashed, ie to wait
+    for it to be put on the station, a false return stops the run
+    setting the cancel event (threading.Event) stops the run after the
+    board being flashed, so does the first board that fails
+    returns a list of (serial number, success, seconds) for the boards that
+    were flashed
+    """
+    cancel = cancel or threading.Event()
+    stop = threading.Event()
+    boards = Queue.Queue(depth)
+    maker = threading.Thread(target=_makeboards, args=(serialnums, pin,
+        pinhigh, directory, boards, stop))
+    maker.daemon = True
+    maker.start()
+
+    results = []
+    try:
+        while not cancel.is_set():
+            try:
+                item = boards.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if item is None:
+                break
+            serialnum, filename, error = item
+            if error is not None and serialnum is None:
+                _say("making the next user page failed: {0}".format(error))
+                break
+            if error is not None:
+                _say("making {0} failed: {1}".format(serialnum, error))
+                break
+            if nextboard is not None and not nextboard(serialnum):
+                break
+            start = time.time()
+            result = flashuser(filename)
+            if result:
+                _say("flashuser failed for {0} with exit code {1}".format(
+                    serialnum, result))
+            elif not waitready(timeout):
+                _say("target not ready {0} s after flashing {1}".format(
+                    timeout, serialnum))
+                result = True
+            else:
+                result = runprogram()
+            results.append((serialnum, not result, time.time() - start))
+            if result:
+                break
+    finally:
+        stop.set()
+        while maker.is_alive():
+            try:
+                boards.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+    return results
+
+def _makeboards(serialnums, pin, pinhigh, directory, boards, stop):
+    """
+    make the user page hex for each serial number and queue
+    (serial number, filename, error) for provision until stop is set,
+    None always comes last
+    an error reading serialnums or making a page is queued with None for
+    the serial number
+    """
+    serialnum = None
+    try:
+        for serialnum, text in userhexes(serialnums, pin, pinhigh):
+            if stop.is_set():
+                break
+            filename = os.path.join(directory, "{0}.hex".format(serialnum))
+            with open(filename, 'w') as fh:
+                fh.write(text)
+            boards.put((serialnum, filename, None))
+            serialnum = None
+    except Exception as e:
+        boards.put((serialnum, None, e))
+    finally:
+        boards.put(None)
+
+def _command(command):
+    """
+    add the probe of the current thread (set by programmany) to an
+    avr32program command
+    """
+    probe = getattr(_target, 'probe', None)
+    if probe is None or command[0] != "avr32program":
+        return command
+    return command[:1] + ["-c", probe] + command[1:]
+
+def settelemetry(jsonfile=None, hook=None):
+    """
+    record every programmer command run by the helpers in here
+    each record is a dict with the step (helper name), command, probe,
+    start time, seconds, exit code and the output of the command
+    records are appended to jsonfile one json object per line and passed to
+    hook(record) so they can go to a metrics system
+    the output is still shown (or logged) but only once the command is done
+    settelemetry() turns recording off again
+    """
+    with _telemetrylock:
+        _telemetry["file"] = jsonfile
+        _telemetry["hook"] = hook
+
+def _run(command, step=None, capture=False):
+    """
+    run a programmer command for the current thread's target, recording it
+    if settelemetry is on
+    a snapshot from devicestate is dropped if step writes to the target
+    returns the exit code, or (exit code, output) if capture is set, in
+    which case the output is not shown
+    """
+    out = getattr(_target, 'out', None)
+    command = _command(command)
+    if step in WRITESTEPS:
+        probe = getattr(_target, 'probe', None)
+        _snapshots.pop(probe, None)
+        if step != "flashchanged":
+            _written.add(probe)
+            if probe in _flashdevices:
+                forgetdevice(*reversed(_flashdevices.pop(probe)))
+    if (not capture and _telemetry["file"] is None and
+            _telemetry["hook"] is None):
+        return call(command, stdout=out, stderr=out)
+
+    start = time.time()
+    error = None
+    try:
+        proc = Popen(command, stdout=PIPE, stderr=STDOUT)
+        output = proc.communicate()[0]
+        result = proc.returncode
+    except OSError as e:
+        error = e
+        output = str(e)
+        result = None
+    seconds = time.time() - start
+    if error is None and not capture:
+        (out or sys.stdout).write(output)
+
+    record = {"step": step or command[0], "command": command,
+            "probe": getattr(_target, 'probe', None), "start": start,
+            "seconds": seconds, "exitcode": result,
+            "output": output.decode('utf-8', 'replace')}
+    with _telemetrylock:
+        if _telemetry["file"] is not None:
+            with open(_telemetry["file"], 'a') as fh:
+                fh.write(json.dumps(record) + "\n")
+        hook = _telemetry["hook"]
+    if hook is not None:
+        hook(record)
+    if error is not None:
+        raise error
+    return (result, output) if capture else result
+
+def _say(message):
+    """ print, or write to the log of the current thread's target """
+    out = getattr(_target, 'out', None)
+    if out is None:
+        print(message)
+    else:
+        out.write(message + "\n")
+        out.flush()
 
 def programBatchisp(filename):
     """
@@ -48,7 +315,7 @@ def programBatchisp(filename):
             "erase", "f", "memory", "flash", "blankcheck",
             "loadbuffer", filename, "program", "verify",
             "start", "reset", "0"]
-    call(command)
+    return _run(command, "programBatchisp")
 
 def parseCFGword(filename="ispcfg.bin", display=True):
     """
@@ -59,10 +326,10 @@ def parseCFGword(filename="ispcfg.bin", display=True):
     values = [ord(c) for c in data]
     if display:
         word = ["{0:0>2X}".format(v) for v in values]
-        print("WORD is: 0x {0} {1} {2} {3}".format(*word))
+        _say("WORD is: 0x {0} {1} {2} {3}".format(*word))
         pin = values[2]
         val = values[1] % 2
-        print("IO Condition: Pin {0} {1}".format(pin, "High" if val else "Low"))
+        _say("IO Condition: Pin {0} {1}".format(pin, "High" if val else "Low"))
     return(values)
 
 def makeCFGFile(word, filename="ispcfg.bin"):
@@ -72,43 +339,17 @@ def makeCFGFile(word, filename="ispcfg.bin"):
     with open(filename, "wb") as fh:
         fh.write(bytearray(word))
 
-def getCRC8(word3):
-    """
-    calculate one byte cyclic redundancy check
-
-    C(x) = x^8 + x^2 + x^1 + x^0 == 1 0 0 0 0 0 1 1 1
-
-    from: http://ghsi.de/CRC/index.php?Polynom=100000111&Message=929E05
-    // ========================================================================
-    // CRC Generation Unit - Linear Feedback Shift Register implementation
-    // (c) Kay Gorontzi, GHSi.de, distributed under the terms of LGPL
-    // ========================================================================
-    """
-    crc = [0, 0, 0, 0, 0, 0, 0, 0]
-    binstr = [int(b) for b in list("{0:b}".format(word3))]
-    for v in binstr:
-        doinvert = v ^ crc[7]
-        crc[7] = crc[6]
-        crc[6] = crc[5]
-        crc[5] = crc[4]
-        crc[4] = crc[3]
-        crc[3] = crc[2]
-        crc[2] = crc[1] ^ doinvert
-        crc[1] = crc[0] ^ doinvert
-        crc[0] = doinvert
-    return sum([c*2**i for i, c in enumerate(crc)])
-
 def commandhelp():
     command = ["avr32program", "help", "commands"]
-    call(command)
+    return _run(command, "commandhelp")
 
 def optionshelp():
     command = ["avr32program", "-h"]
-    call(command)
+    return _run(command, "optionshelp")
 
 def getStatus():
     command = ["avr32program", "status"]
-    call(command)
+    return _run(command, "getStatus")
 
 def cpuinfo(full=False):
     """
@@ -117,7 +358,7 @@ def cpuinfo(full=False):
     command = ["avr32program", "cpuinfo"]
     if full: 
         command.append("-F")
-    call(command)
+    return _run(command, "cpuinfo")
 
 def chiperase(full=False):
     """
@@ -126,7 +367,7 @@ def chiperase(full=False):
     command = ["avr32program", "chiperase"]
     if full: 
         command.append("-F")
-    call(command)
+    return _run(command, "chiperase")
 
 def flashBootloader(filename="at32uc3b-isp-1.0.3.bin"):
     """
@@ -141,7 +382,7 @@ def flashBootloader(filename="at32uc3b-isp-1.0.3.bin"):
             "-e",
             "-cxtal",
             filename]
-    call(command)
+    return _run(command, "flashBootloader")
 
 def flashCFGword(filename="ispcfg.bin"):
     """
@@ -156,7 +397,7 @@ def flashCFGword(filename="ispcfg.bin"):
             "-cxtal",
             filename]
     value = parseCFGword(filename)
-    call(command)
+    return _run(command, "flashCFGword")
 
 def flashuser(filename="userpage.hex"):
     command = ["avr32program", "program",
@@ -167,7 +408,243 @@ def flashuser(filename="userpage.hex"):
             "-e",
             "-cxtal",
             filename]
-    call(command)
+    return _run(command, "flashuser")
+
+def flashchanged(device, filename, offset=0x80000000,
+        statefile="flashstate.json", pagesize=512):
+    """
+    flash only the pages of an image that differ from what was last flashed
+    to device through here (device is any id, ie the serial number from
+    userserial)
+    filename is a .hex, or a .bin that is placed at offset
+    a hash of every flash page written is kept per device in statefile, if
+    no page changed nothing is run, otherwise just the changed pages are
+    programmed without a chip erase (no -e) so the rest of the flash is
+    left as it is
+    it is not known whether avr32program erases a page before writing it
+    when -e is not given, the write is verified (-v) and if that fails the
+    whole image is programmed again after a chip erase, so a page is never
+    left half written
+    any other helper in here that writes to the target (see WRITESTEPS)
+    makes the next flashchanged on it program every page, and drops the
+    device from statefile if flashchanged already ran on that target, use
+    forgetdevice after programming it by other means
+    statefile can be shared by the threads of programmany, each only
+    changes the entry of its own device
+    returns the exit code, 0 when nothing needed doing
+    """
+    probe = getattr(_target, 'probe', None)
+    pages = _pagehashes(_loadimage(filename, offset), pagesize)
+    keys = ["{0:0>8X}".format(address) for address, data, digest in pages]
+
+    with _statelock:
+        flashed = _loadstate(statefile).get(device, {})
+    if probe in _written:
+        flashed = {}
+    changed = [(address, data) for key, (address, data, digest)
+            in zip(keys, pages) if flashed.get(key) != digest]
+    if not changed:
+        _say("{0}: {1} unchanged, skipped".format(device, filename))
+        _flashdevices[probe] = (statefile, device)
+        return 0
+
+    _say("{0}: {1} of {2} pages changed".format(device, len(changed),
+        len(pages)))
+    # until the write is done the pages being written are not known
+    _updatestate(statefile, device, probe in _written, keys)
+    _written.discard(probe)
+    result = _programpages(changed, erase=False)
+    if result and len(changed) < len(pages):
+        _say("{0}: writing the changed pages failed, programming all of "
+                "{1}".format(device, filename))
+        _updatestate(statefile, device, True)
+        result = _programpages([(address, data)
+            for address, data, digest in pages], erase=True)
+    if result == 0:
+        _updatestate(statefile, device, False, (), dict(zip(keys,
+            (digest for address, data, digest in pages))))
+        _flashdevices[probe] = (statefile, device)
+    return result
+
+def _updatestate(statefile, device, clear=False, drop=(), add=None):
+    """
+    change the statefile entry of device: clear it, then remove the pages
+    in drop and add the page: hash items in add
+    """
+    with _statelock:
+        state = _loadstate(statefile)
+        flashed = {} if clear else state.get(device, {})
+        for key in drop:
+            flashed.pop(key, None)
+        flashed.update(add or {})
+        state[device] = flashed
+        _savestate(statefile, state)
+
+def forgetdevice(device, statefile="flashstate.json"):
+    """
+    drop device from the flashchanged statefile, so the next flashchanged
+    programs every page of it
+    """
+    with _statelock:
+        state = _loadstate(statefile)
+        if state.pop(device, None) is not None:
+            _savestate(statefile, state)
+
+def _programpages(segments, erase=False):
+    """
+    program (address, data) segments in one avr32program session, with a
+    chip erase first if erase is set, returns the exit code
+    """
+    fd, deltafile = tempfile.mkstemp(suffix=".hex")
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(segments2hex(segments))
+        command = ["avr32program", "program",
+                "-Fhex",
+                "-v",
+                "-finternal@0x80000000"]
+        if erase:
+            command.append("-e")
+        command.extend(["-cxtal", deltafile])
+        return _run(command, "flashchanged")
+    finally:
+        os.remove(deltafile)
+
+def _loadstate(statefile):
+    """ the flashchanged state, {} if there is no statefile yet """
+    if not os.path.exists(statefile):
+        return {}
+    with open(statefile, 'r') as fh:
+        return json.load(fh)
+
+def _savestate(statefile, state):
+    """ write the flashchanged state through a temp file and rename """
+    fd, tmp = tempfile.mkstemp(suffix=".tmp",
+            dir=os.path.dirname(os.path.abspath(statefile)))
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(state, fh, indent=1, sort_keys=True)
+    os.rename(tmp, statefile)
+
+def _pagehashes(segments, pagesize=512):
+    """
+    cut (address, data) segments at flash page boundaries
+    returns a list of (address, data, sha1) for each piece
+    """
+    pages = []
+    for address, data in segments:
+        k = 0
+        while k < len(data):
+            n = pagesize - (address + k) % pagesize
+            piece = bytes(data[k:k + n])
+            pages.append((address + k, piece, hashlib.sha1(piece).hexdigest()))
+            k += n
+    return pages
+
+def userserial(filename="userpage.hex"):
+    """
+    return the serial number from the start of a user page .hex or .bin
+    """
+    if os.path.splitext(filename)[1].lower() == ".hex":
+        page = readhex(filename)[0][1]
+    else:
+        with open(filename, 'rb') as fh:
+            page = bytearray(fh.read())
+    end = page.find(b"\x00")
+    if end < 0 or page[0] == 0xFF:
+        return ""
+    return page[:end].decode('ascii')
+
+def makeimage(hexfile="production.hex", application=None,
+        appoffset=0x80002000, userpage=None,
+        bootloader="at32uc3b-isp-1.0.3.bin", cfgfile="ispcfg.bin", cols=16):
+    """
+    merge the bootloader (0x80000000), isp cfg word (0x808001FC), user page
+    (0x80800000) and application (.bin at appoffset or a .hex) into one hex
+    file that flashimage programs in a single session
+    userpage is a .hex or .bin file or the page itself, ie from
+    makeuser.makepage, any part can be None to leave it out
+    a ValueError is raised if parts overlap with different bytes, the cfg
+    word may overlap a user page that already holds the same word
+    returns the list of merged (address, bytearray) segments
+    """
+    segments = []
+    if bootloader is not None:
+        segments.extend(_loadimage(bootloader, 0x80000000))
+    if cfgfile is not None:
+        segments.extend(_loadimage(cfgfile, 0x808001FC))
+    if userpage is not None:
+        if isinstance(userpage, basestring):
+            segments.extend(_loadimage(userpage, 0x80800000))
+        else:
+            segments.append((0x80800000, userpage))
+    if application is not None:
+        segments.extend(_loadimage(application, appoffset))
+    segments = mergesegments(segments)
+    with open(hexfile, 'w') as fh:
+        fh.write(segments2hex(segments, cols))
+    return segments
+
+def flashimage(filename="production.hex"):
+    """
+    program a multi segment hex (see makeimage) in one avr32program session
+    """
+    command = ["avr32program", "program",
+            "-Fhex",
+            "-v",
+            "-finternal@0x80000000",
+            "-e",
+            "-cxtal",
+            filename]
+    return _run(command, "flashimage")
+
+def _loadimage(filename, offset):
+    """
+    (address, data) segments of a .hex, or of a binary placed at offset
+    """
+    if os.path.splitext(filename)[1].lower() == ".hex":
+        return readhex(filename)
+    with open(filename, 'rb') as fh:
+        return [(offset, bytearray(fh.read()))]
+
+def devicestate(refresh=False):
+    """
+    read the fuses and cpu info of the current target (the thread's probe,
+    see programmany) in one go and keep them
+    later calls give the same snapshot without talking to the target, until
+    one of the helpers that writes to it runs (see WRITESTEPS) or refresh
+    is set
+    returns a dict with fuses (the word), fusebits (see decodefuses) and
+    cpuinfo (the text avr32program gives)
+    raises an IOError if either could not be read
+    """
+    probe = getattr(_target, 'probe', None)
+    if not refresh and probe in _snapshots:
+        return _snapshots[probe]
+
+    result, output = _run(["avr32program", "readfuses",
+        "-finternal@0x80000000", "gp"], "devicestate", capture=True)
+    match = re.search(r"\bgp\s*[=:]\s*0x([0-9A-Fa-f]{8})\b", output,
+            re.IGNORECASE)
+    if result or match is None:
+        raise IOError("could not read the fuses: {0}".format(output))
+    fuses = int(match.group(1), 16)
+
+    result, info = _run(["avr32program", "cpuinfo"], "devicestate",
+            capture=True)
+    if result:
+        raise IOError("could not read the cpu info: {0}".format(info))
+
+    state = {"fuses": fuses, "fusebits": decodefuses(fuses), "cpuinfo": info}
+    _snapshots[probe] = state
+    return state
+
+def decodefuses(fuses):
+    """
+    split the general purpose fuse word into its fields, as laid out in
+    writefuses, returned as a dict of name: value
+    """
+    return dict((name, (fuses >> shift) & ((1 << width) - 1))
+            for name, shift, width in FUSE_FIELDS)
 
 def writefuses(fuses='0x8C07FFFF'):
     """
@@ -186,40 +663,78 @@ def writefuses(fuses='0x8C07FFFF'):
     command = ["avr32program", "writefuses",
             "-finternal@0x80000000", 
             "gp={0}".format(fuses)]
-    call(command)
+    return _run(command, "writefuses")
 
 def runprogram():
     """
     start the application
     """
     command = ["avr32program", "run", "-R"]
-    call(command)
+    return _run(command, "runprogram")
 
 def readfuses():
     command = ["avr32program", "readfuses",
             "-f internal@0x80000000",
             "gp"]
-    call(command)
+    return _run(command, "readfuses")
 
 def lsusb(grep="03eb"):
     """
     doesn't work
     """
     command = ["lsusb"]
-    call(command)
+    return _run(command, "lsusb")
 
-def viewuser(filename="userpage.bin", cols=16):
+def viewuser(filename="userpage.bin", cols=16, base=0x80800000):
     """
     used to view the contents of the user page in hex format
     """
+    if os.path.getsize(filename) != 512:
+        log.warn("User page should be 512 bytes")
+    hexdump(filename, base, cols)
+
+def hexdump(filename, base=0, cols=16, start=0, length=None, collapse=True,
+        out=None):
+    """
+    print the contents of a binary file in hex, cols bytes to a row, each
+    row labelled with its address (base is the address of the first byte
+    of the file)
+    start and length pick a range of the file (length None for the rest)
+    with collapse a run of rows the same as the one before (ie erased flash)
+    is shown as a single *
+    the file is read and written a block of rows at a time so any size works
+    out is the file to write to, default stdout
+    """
+    out = sys.stdout if out is None else out
+    size = os.path.getsize(filename)
+    stop = size if length is None else min(size, start + length)
+    block = cols * 4096
+    previous = None
+    starred = False
     with open(filename, 'rb') as fh:
-        page = fh.read()
-    if len(page) != 512: log.warn("User page should be 512 bytes")
-    for k in range((512+cols-1)//cols):
-        print ("{0:0>2X}: ".format(k), end="")
-        for i in range(cols):
-            print ("{0:0>2X} ".format(ord(page[i+k*cols])), end="")
-        print("")
+        fh.seek(start)
+        position = start
+        while position < stop:
+            data = bytearray(fh.read(min(block, stop - position)))
+            if not data:
+                break
+            lines = []
+            for k in range(0, len(data), cols):
+                row = data[k:k + cols]
+                if collapse and row == previous:
+                    if not starred:
+                        lines.append("*")
+                        starred = True
+                    continue
+                previous = row
+                starred = False
+                lines.append("{0:0>8X}: ".format(base + position + k) +
+                        ("%02X " * len(row)) % tuple(row))
+            if lines:
+                out.write("\n".join(lines) + "\n")
+            position += len(data)
+    if starred:
+        out.write("{0:0>8X}:\n".format(base + stop))
 
 def makeuser(serialnumber="", pin=5, pinhigh=False, filename='userpage'):
     """
@@ -253,19 +768,13 @@ def makeuser(serialnumber="", pin=5, pinhigh=False, filename='userpage'):
 
 def _makeCFGWord(pin=5, pinhigh=False):
     """ make the cfg word, including a checksum based on a certain pin number and
-    pin condition 
+    pin condition
     returns the word as a list with 4 byte values
     """
-    magic = 0x494F
-    pval = 1 if pinhigh else 0
-    word3 = ((magic<<17) + (pval<<16) + (pin<<8))>>8
-    print ("First 3 bytes: 0x{0:0>6X}".format(word3))
-    crc8 = getCRC8(word3)
-    print ("Checksum (CRC8): 0x{0:0>2X}".format(crc8))
-    word = (word3<<8) + crc8
-    whex = "{0:0>8X}".format(word)
-    print ("Word is: 0x{0}".format(whex))
-    wvals = [int(whex[2 * i : 2 * i + 2], 16) for i in range(4)]
+    wvals = cfgword(pin, pinhigh)
+    _say("First 3 bytes: 0x{0:0>2X}{1:0>2X}{2:0>2X}".format(*wvals))
+    _say("Checksum (CRC8): 0x{0:0>2X}".format(wvals[3]))
+    _say("Word is: 0x{0:0>2X}{1:0>2X}{2:0>2X}{3:0>2X}".format(*wvals))
     return wvals
 
 def makehex(binfile="program.bin", hexfile=None, offset=0x80000000, cols=16):
@@ -339,10 +848,24 @@ def _ihex_makeline(values):
 def makeBin(binfile="userpage.bin", hexfile="userpage.hex"):
     """
     make a binary file from an intel hex file
-    """
-    # if the entire data is continuous, make 1 file, list address start loc.
-    # if multiple blocks exist in hex, make multiple files each w/ offset.
-    pass
+    if the data is continuous one file is made, otherwise each block is
+    written to its own file named with the block address, ie
+    userpage_80800000.bin
+    returns a list of (address, filename) for the files that were made
+    """
+    segments = readhex(hexfile)
+    if len(segments) == 1:
+        names = [binfile]
+    else:
+        root, ext = os.path.splitext(binfile)
+        names = ["{0}_{1:0>8X}{2}".format(root, address, ext)
+                for address, data in segments]
+    made = []
+    for (address, data), name in zip(segments, names):
+        with open(name, 'wb') as fh:
+            fh.write(data)
+        made.append((address, name))
+    return made
 
 
 if __name__=="__main__":